@@ -24,6 +24,7 @@ setup(
         'mongoengine>=0.3',
         'nltk',
         'flask',
+        'flask-compress',
         'simplejson',
         'cython',
         'numpy',
@@ -36,6 +37,12 @@ setup(
         # 'pymongo',
         # 'pyyaml',
     ],
+    extras_require={
+        'experiments': ['numba'],  # simulate_search and stroke_numba
+        'fast-gzip': ['rapidgzip'],  # parallel decompression of FREQ_SOURCE
+        'wire-compression': ['pymongo[zstd,snappy]'],
+        'async': ['motor'],  # settings.get_async_db()
+    },
     packages=['simsearch'],
     ext_modules=[Extension(
             'simsearch.stroke',
@@ -26,6 +26,12 @@ app.config.from_object('simsearch.settings')
 if 'SIMSEARCH_SETTINGS' in os.environ:
     app.config.from_envvar('SIMSEARCH_SETTINGS')
 
+if app.config['ENABLE_HTTP_GZIP']:
+    from flask_compress import Compress
+    app.config.setdefault('COMPRESS_ALGORITHM', ['gzip', 'deflate'])
+    app.config.setdefault('COMPRESS_MIN_SIZE', app.config['GZIP_MIN_LENGTH'])
+    Compress(app)
+
 
 @app.route('/help/')
 def help():
@@ -63,7 +69,7 @@ def index():
         return flask.render_template('search/index.html', **context)
 
     try:
-        node = models.Node.objects.get(pivot=kanji)
+        neighbours = models.cached_neighbours(kanji)
     except mongoengine.queryset.DoesNotExist:
         context['error'] = u'Sorry, %s not found' % kanji
         return flask.render_template('search/index.html', **context)
@@ -74,7 +80,6 @@ def index():
         path = []
 
     path = list(path) + [kanji]
-    neighbours = [n.kanji for n in sorted(node.neighbours, reverse=True)]
     neighbours = neighbours[:app.config['N_NEIGHBOURS_RECALLED']]
 
     context.update({'data': simplejson.dumps({
@@ -113,8 +118,7 @@ def translate(kanji):
 def search_json(pivot):
     """Returns the search display data as JSON."""
     pivot = pivot or flask.request.args.get('pivot')
-    node = models.Node.objects.get(pivot=pivot)
-    neighbours = [n.kanji for n in sorted(node.neighbours, reverse=True)]
+    neighbours = models.cached_neighbours(pivot)
     neighbours = neighbours[:app.config['N_NEIGHBOURS_RECALLED']]
 
     return flask.jsonify(
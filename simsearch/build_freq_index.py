@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  build_freq_index.py
+#  simsearch
+
+"""
+Decompresses the corpus frequency counts once, at deploy time, into a numpy
+array which settings can then memory-map instead of parsing the gzip file.
+"""
+
+import sys
+import optparse
+
+import numpy as np
+
+from simsearch import settings
+
+FREQ_DTYPE = np.dtype([('cp', 'u4'), ('count', 'u8')])
+
+
+def build_freq_index(output_file=None):
+    if output_file is None:
+        output_file = settings.FREQ_SOURCE_NPY
+
+    # parse the source itself, not load_freq(), which would hand back the
+    # existing array whenever it is up to date
+    print(f'Reading {settings.FREQ_SOURCE}')
+    counts = settings.cached_parse(settings.FREQ_SOURCE, settings._parse_freq)
+
+    freq_array = np.fromiter(((ord(k), c) for (k, c) in counts.items()),
+                             dtype=FREQ_DTYPE, count=len(counts))
+
+    print(f'Writing {len(freq_array)} counts to {output_file}')
+    np.save(output_file, freq_array)
+
+
+# ---------------------------------------------------------------------------- #
+
+
+def _create_option_parser():
+    usage = \
+        """%prog [options]
+
+        Pre-decompresses the corpus frequency counts into a numpy array."""
+
+    parser = optparse.OptionParser(usage)
+
+    parser.add_option(
+        '-o', action='store', dest='output_file',
+        help='Where to write the array [settings.FREQ_SOURCE_NPY]')
+
+    return parser
+
+
+def main(argv):
+    parser = _create_option_parser()
+    (options, args) = parser.parse_args(argv)
+
+    if args:
+        parser.print_help()
+        sys.exit(1)
+
+    build_freq_index(output_file=options.output_file)
+
+# ---------------------------------------------------------------------------- #
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -25,20 +25,30 @@ from simsearch.experiments.simulate_search import TraceFile
 
 def evaluate_paths(input_file, limit=5):
     print(f'Evaluating paths from "{os.path.basename(input_file)}"')
-    traces = TraceFile.load(input_file)
 
-    path_lengths = []
-    successes = []
-    for (query, target, path) in traces:
+    # a single streaming pass only needs to count how many traces have each
+    # length; failures count as the limit, and successful paths are usually
+    # within it, but the histogram grows for any that aren't
+    length_counts = np.zeros(limit + 1, dtype=np.int64)
+    n_successes = 0
+    for (query, target, path) in TraceFile.iter_traces(input_file):
         if path and path[-1] == target:
-            successes.append(path)
-            path_lengths.append(len(path) - 1)
+            n_successes += 1
+            length = len(path) - 1
+            if length >= len(length_counts):
+                length_counts = np.pad(length_counts,
+                                       (0, length + 1 - len(length_counts)))
+            length_counts[length] += 1
         else:
-            path_lengths.append(limit)
+            length_counts[limit] += 1
 
-    print(f'Success rate: {len(successes)}/{len(traces)} ({100.0 * len(successes) / len(traces):.2f})')
+    n_traces = length_counts.sum()
+    print(f'Success rate: {n_successes}/{n_traces} ({100.0 * n_successes / n_traces:.2f})')
 
-    print(f'Mean path length: {np.mean(path_lengths):.2f} (σ = {np.std(path_lengths):.2f})')
+    lengths = np.arange(len(length_counts))
+    mean = np.average(lengths, weights=length_counts)
+    std = np.sqrt(np.average((lengths - mean) ** 2, weights=length_counts))
+    print(f'Mean path length: {mean:.2f} (σ = {std:.2f})')
 
 # ---------------------------------------------------------------------------- #
 
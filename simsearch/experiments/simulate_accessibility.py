@@ -20,7 +20,6 @@ import optparse
 import random
 import bz2
 import gzip
-import codecs
 
 import numpy as np
 from math import log
@@ -49,23 +48,25 @@ def sopen(filename, mode='rb', encoding='utf8'):
     if read_mode and 'w' in mode:
         raise Exception("Must be either read mode or write, but not both")
 
+    if encoding in (None, 'byte'):
+        encoding = None
+    else:
+        # decode natively in text mode rather than through a codecs wrapper
+        mode = mode.replace('b', '').replace('t', '') + 't'
+
     if filename.endswith('.bz2'):
-        stream = bz2.BZ2File(filename, mode)
+        stream = bz2.open(filename, mode, encoding=encoding)
     elif filename.endswith('.gz'):
-        stream = gzip.GzipFile(filename, mode)
+        stream = gzip.open(filename, mode, encoding=encoding)
     elif filename == '-':
         if read_mode:
             stream = sys.stdin
         else:
             stream = sys.stdout
+        if encoding is None:
+            stream = stream.buffer
     else:
-        stream = open(filename, mode)
-
-    if encoding not in (None, 'byte'):
-        if read_mode:
-            return codecs.getreader(encoding)(stream)
-        else:
-            return codecs.getwriter(encoding)(stream)
+        stream = open(filename, mode, encoding=encoding)
 
     return stream
 
@@ -127,12 +128,22 @@ class FreqDist(dict):
 
         super().__init__()
         self._total = 0
+        self._prob_map = None
 
         if pairSeq is not None:
             for sample, count in pairSeq:
                 self[sample] = count
                 self._total += count
 
+    def __setitem__(self, sample, count):
+        # any change to the counts invalidates a frozen snapshot
+        self._prob_map = None
+        super().__setitem__(sample, count)
+
+    def __delitem__(self, sample):
+        self._prob_map = None
+        super().__delitem__(sample)
+
     def inc(self, sample, n=1):
         self.__setitem__(sample, self.get(sample, 0) + n)
         self._total += n
@@ -172,8 +183,36 @@ class FreqDist(dict):
         """Return the frequency count of the sample."""
         return self.get(sample, 0)
 
+    def freeze(self):
+        """
+        Snapshots the current counts as numpy arrays, computing the
+        probability of every sample in one vectorised pass. The snapshot is
+        discarded by any later item assignment or deletion, including those
+        made by inc() and friends (but not by dict.update()).
+        >>> x = FreqDist([('a', 3), ('b', 1), ('c', 0)])
+        >>> x.freeze()
+        >>> x.candidates()
+        [('a', -0.2876820724517809), ('b', -1.3862943611198906), ('c', -inf)]
+        >>> x.inc('b', 4)
+        >>> x.prob('b')
+        0.625
+        >>> x.candidates()[1]
+        ('b', -0.4700036292457356)
+        """
+        self._keys = np.array(list(self.keys()), dtype=object)
+        self._counts = np.fromiter(self.values(), dtype=np.int64,
+                                   count=len(self))
+        probs = self._counts / float(self._total)
+        with np.errstate(divide='ignore'):
+            # zero counts get a log probability of -inf
+            self._log_probs = np.log(probs)
+        self._prob_map = dict(zip(self._keys.tolist(), probs.tolist()))
+
     def prob(self, sample):
         """Returns the MLE probability of this sample."""
+        if self._prob_map is not None:
+            return self._prob_map.get(sample, 0.0)
+
         c = self.get(sample, 0)
         if c > 0:
             return c / float(self._total)
@@ -189,10 +228,10 @@ class FreqDist(dict):
         Returns a list of (sample, log_prob) pairs, using the log MLE
         probability of each sample.
         """
-        return [
-            (k, log(v / float(self._total)))
-            for (k, v) in self.items()
-        ]
+        if self._prob_map is None:
+            self.freeze()
+
+        return list(zip(self._keys.tolist(), self._log_probs.tolist()))
 
     def dump(self, filename):
         """
@@ -216,12 +255,14 @@ class FreqDist(dict):
         one file.
         """
         i_stream = sopen(filename, 'r')
-        for line in i_stream:
+        data = i_stream.read()
+        i_stream.close()
+
+        for line in data.splitlines():
             key, count = line.rstrip().split(SYMBOL_SEP)
             key = _unescape_spaces(key)
             count = int(count)
             self.inc(key, count)
-        i_stream.close()
 
         return
 
@@ -245,38 +286,48 @@ class FreqDist(dict):
 
 def simulate_accessibility(output_file):
     print('Loading frequency distribution')
-    dist = FreqDist.from_file(settings.FREQ_SOURCE)
+    dist = FreqDist(settings.load_freq().items())
 
     print('Loading kanji')
     kanji_set = list(models._get_kanji())
     random.seed(123456789)
     random.shuffle(kanji_set)
 
-    kanji_in_order = sorted(kanji_set, key=lambda k: dist.prob(k))
+    # a stable sort by count, so that the shuffle breaks ties
+    counts = np.fromiter((dist.get(k, 0) for k in kanji_set), dtype=np.int64,
+                         count=len(kanji_set))
+    order = np.argsort(counts, kind='stable')
+    kanji_in_order = [kanji_set[i] for i in order]
 
     print('Loading graph')
     graph = RestrictedGraph()
 
+    # kanji are identified by their position in study order, so the i-th
+    # kanji learned is kanji i
+    kanji_to_idx = {kanji: i for i, kanji in enumerate(kanji_in_order)}
+    neighbour_idxs = [
+        np.array([kanji_to_idx[n] for n in graph[kanji]], dtype=np.int32)
+        for kanji in kanji_in_order
+    ]
+    n_neighbours = np.fromiter(map(len, neighbour_idxs), dtype=np.int32,
+                               count=len(neighbour_idxs))
+
     print(f'Dumping frequencies to {os.path.basename(output_file)}')
-    n_neighbours = []
-    with codecs.open(output_file, 'w', 'utf8') as ostream:
+    with open(output_file, 'w', encoding='utf8') as ostream:
         print(u'#n_known,n_accessible', file=ostream)
         print(f'{0},{0}', file=ostream)
-        known_set = set()
-        accessible_set = set()
-        for i, kanji in enumerate(kanji_in_order):
-            known_set.add(kanji)
-            accessible_set.add(kanji)
-
-            neighbours = graph[kanji]
-            accessible_set.update(neighbours)
-            n_neighbours.append(len(neighbours))
+        accessible = np.zeros(len(kanji_in_order), dtype=bool)
+        n_known = 0
+        for i, neighbours in enumerate(neighbour_idxs):
+            n_known = i + 1
+            accessible[i] = True
+            accessible[neighbours] = True
 
-            if (i + 1) % 50 == 0:
-                print(f'{len(known_set)},{len(accessible_set)}', file=ostream)
-        print(f'{len(known_set)},{len(accessible_set)}', file=ostream)
+            if n_known % 50 == 0:
+                print(f'{n_known},{accessible.sum()}', file=ostream)
+        print(f'{n_known},{accessible.sum()}', file=ostream)
 
-    print(f'Average neighbourhood size: {np.mean(n_neighbours):.3f} (σ = {n_neighbours:.3f})')
+    print(f'Average neighbourhood size: {np.mean(n_neighbours):.3f} (σ = {np.std(n_neighbours):.3f})')
 
 
 class RestrictedGraph(object):
@@ -285,11 +336,12 @@ class RestrictedGraph(object):
         self._threshold = threshold
 
     def __getitem__(self, kanji):
-        neighbour_heap = self._graph[kanji]
-        ordered_neighbourhood = sorted(neighbour_heap.get_contents(), reverse=True)
+        neighbourhood = self._graph[kanji].get_contents()
 
-        first_sim, first_neighbour = ordered_neighbourhood[0]
-        cutoff_neighbours = set(n for (s, n) in ordered_neighbourhood if s >= self._threshold * first_sim)
+        # only the best similarity matters for the cutoff, so no need to sort
+        first_sim = max(s for (s, n) in neighbourhood)
+        cutoff = self._threshold * first_sim
+        cutoff_neighbours = set(n for (s, n) in neighbourhood if s >= cutoff)
 
         return cutoff_neighbours
 
@@ -17,35 +17,50 @@ generated by this script can be analysed as a form of intrinsic evaluation.
 import os
 import sys
 import optparse
-import codecs
 import random
-
+import hashlib
+import functools
+import multiprocessing
+import zlib
+import itertools
+import time
+
+import numpy as np
+from numba import njit
 from tqdm import tqdm
 
-from simsearch import settings, stroke, models
+from simsearch import settings, stroke_numba, models
 
 
 def simulate_search(output_file, strategy='greedy',
-        k=settings.N_NEIGHBOURS_RECALLED, error_rate=0.0):
+        k=settings.N_NEIGHBOURS_RECALLED, error_rate=0.0, processes=None):
     """
     Simulate user searches on every query/target pair from the flashcard
     dataset, using one of the available strategies. The resulting query paths
-    are dumped to the specified file.
+    are dumped to the specified file. Searches are spread over the given
+    number of worker processes (all cores by default).
     """
     if strategy == 'greedy':
         search_fn = _greedy_search
     elif strategy == 'shortest':
         search_fn = _breadth_first_search
     elif strategy == 'random':
-        random.seed(123456789)
         search_fn = _random_stumble
     else:
         raise ValueError(strategy)
 
-    traces = []
-    for query, target in tqdm(_load_search_examples()):
-        path = search_fn(query, target, k=k, error_rate=error_rate)
-        traces.append((query, target, path))
+    _warmup()
+
+    examples = _load_search_examples()
+    run_search = functools.partial(_run_search, search_fn, k=k,
+                                   error_rate=error_rate)
+    if processes == 1:
+        traces = [run_search(example) for example in tqdm(examples)]
+    else:
+        # workers are forked after the preload, so they share its caches
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            traces = list(tqdm(pool.imap(run_search, examples, chunksize=64),
+                               total=len(examples)))
 
     TraceFile.save(traces, output_file)
     print(f'Paths dumped to {output_file}')
@@ -55,29 +70,31 @@ class TraceFile(object):
     """A basic human-readable query path file format."""
     @staticmethod
     def save(traces, filename):
-        with codecs.open(filename, 'w', 'utf8') as ostream:
-            print(u"#query\ttarget\tvia", file=ostream)
-            for query, target, path in traces:
-                if path:
-                    assert path[0] == query
-                    # have at least a partial search
-                    if path[-1] == target:
-                        # success
-                        print(u'%s\t%s\t[%s]' % (query, target, ''.join(path[1:-1])), file=ostream)
-
-                    else:
-                        # failure with partial path
-                        print(u'%s\t(%s)\t[%s]' % (query, target, ''.join(path[1:])), file=ostream)
-                
+        lines = ["#query\ttarget\tvia\n"]
+        for query, target, path in traces:
+            if path:
+                assert path[0] == query
+                # have at least a partial search
+                if path[-1] == target:
+                    # success
+                    lines.append(f"{query}\t{target}\t[{''.join(path[1:-1])}]\n")
+
                 else:
-                    # failure without partial path
-                    print(u'%s\t(%s)\tNone' % (query, target), file=ostream)
+                    # failure with partial path
+                    lines.append(f"{query}\t({target})\t[{''.join(path[1:])}]\n")
+
+            else:
+                # failure without partial path
+                lines.append(f"{query}\t({target})\tNone\n")
+
+        with open(filename, 'w', encoding='utf8') as ostream:
+            ostream.writelines(lines)
 
     @staticmethod
-    def load(filename):
-        traces = []
-        with codecs.open(filename, 'r', 'utf8') as istream:
-            header = istream.next()
+    def iter_traces(filename):
+        """Lazily yields (query, target, path) for each trace in the file."""
+        with open(filename, 'r', encoding='utf8') as istream:
+            header = next(istream)
             assert header.startswith('#')
             for line in istream:
                 query, target, path = line.rstrip().split('\t')
@@ -95,40 +112,78 @@ class TraceFile(object):
                     if was_success:
                         path.append(target)
 
-                traces.append((query, target, path))
+                yield query, target, path
 
-        return traces
+    @staticmethod
+    def load_all(filename):
+        return list(TraceFile.iter_traces(filename))
 
 
 def _load_search_examples():
     flashcard_file = os.path.join(settings.DATA_DIR, 'similarity', 'flashcard')
+    with open(flashcard_file, 'r', encoding='utf8') as istream:
+        data = istream.read()
+
     results = []
-    with codecs.open(flashcard_file, 'r', 'utf8') as istream:
-        for line in istream:
-            _id, query, targets = line.split()
-            for target in targets:
-                results.append((query, target))
+    for line in data.splitlines():
+        _id, query, targets = line.split()
+        results.extend((query, target) for target in targets)
 
     return results
 
 
+def _warmup():
+    """
+    Loads the neighbour graph and materialises all pairwise distances before
+    any searching, so that the search loop runs entirely in memory and
+    forked workers inherit warm caches.
+    """
+    start = time.time()
+    _preload_neighbours()
+    print(f'Loaded neighbour graph in {time.time() - start:.2f}s')
+
+    start = time.time()
+    dist = _get_sed_matrix()
+    print(f'Loaded distance matrix in {time.time() - start:.2f}s')
+
+    start = time.time()
+    indptr, indices = _get_neighbour_csr()
+    # an empty search compiles the kernel once, rather than in every worker
+    _bfs(0, 0, 0, 0, indptr, indices, np.zeros(len(dist.kanji)))
+    print(f'Prepared search graph in {time.time() - start:.2f}s')
+
+
+def _run_search(search_fn, example, k=settings.N_NEIGHBOURS_RECALLED,
+        error_rate=0.0):
+    """
+    Runs a single search, seeding the random number generator from the
+    example itself so that results don't depend on how work is scheduled.
+    """
+    query, target = example
+    random.seed(zlib.crc32((query + target).encode('utf8')))
+    path = search_fn(query, target, k=k, error_rate=error_rate)
+    return query, target, path
+
+
 def _greedy_search(query, target, limit=5, k=settings.N_NEIGHBOURS_RECALLED, error_rate=0.0):
     """
     Simulate a search between the query and target where the user always
     chooses the next kanji which looks closest to the target.
     """
     assert query != target
-    if query not in sed or target not in sed:
+    dist = _get_sed_matrix()
+    if query not in dist.index or target not in dist.index:
         # we can't simulate this search type without using a distance
         # heuristic
         return
 
+    closest = dist.closest
     path = [query]
-    while path[-1] != target and len(path) <= limit:
-        assert path[0] == query
-
-        new_query = path[-1]
-        neighbours = _get_neighbours(new_query, k=k)
+    path_set = {query}
+    new_query = query
+    # the target is never chosen as a step, so only the length needs checking
+    while len(path) <= limit:
+        neighbours = _get_neighbours(new_query, k)
 
         if target in neighbours:
             if error_rate == 0.0 or random.random() < (1 - error_rate)**k:
@@ -137,50 +192,92 @@ def _greedy_search(query, target, limit=5, k=settings.N_NEIGHBOURS_RECALLED, err
                 return path
 
             # Recognition error =(
-            neighbours.remove(target)
+            neighbours = neighbours - {target}
 
         # Our options are neighbours we haven't tried yet
-        options = neighbours.difference(path)
+        options = neighbours - path_set
 
         if not options:
             # Search exhausted =(
             break
 
         # Choose the one visually most similar to the target
-        _d, neighbour = min((sed(n, target), n) for n in options)
-        path.append(neighbour)
+        new_query = closest(options, target)
+        path.append(new_query)
+        path_set.add(new_query)
 
     assert path[0] == query and path[-1] != target
 
     return path
 
 
-def _breadth_first_search(query, target, limit=5, k=settings.N_NEIGHBOURS_RECALLED):
+def _breadth_first_search(query, target, limit=5, k=settings.N_NEIGHBOURS_RECALLED, error_rate=0.0):
     """
     Perform breadth first search to a fixed depth limit, returning the
-    shortest path from the query to the target (within the limit).
+    shortest path from the query to the target (within the limit). The
+    error rate is accepted for a common signature, but ignored.
     """
-    paths = [[query]]
-    shortest = {query}  # has a shortest path been checked
-    while paths:
-        current = paths.pop(0)
-        current_query = current[-1]
-        neighbours = _get_neighbours(current_query, k=k)
+    dist = _get_sed_matrix()
+    if query not in dist.index or target not in dist.index:
+        return
 
-        if target in neighbours:
-            current.append(target)
-            assert current[0] == query
-            return current
+    indptr, indices = _get_neighbour_csr()
+    j = dist.index[target]
+    # neighbours are visited in order of similarity to the target
+    target_dists = dist.raw[:, j] / np.maximum(dist.n_strokes,
+                                               dist.n_strokes[j])
+
+    path = _bfs(dist.index[query], j, k, limit, indptr, indices, target_dists)
+    if len(path):
+        return [dist.kanji[i] for i in path]
+
+
+@njit(cache=True)
+def _bfs(query, target, k, limit, indptr, indices, target_dists):
+    """
+    Breadth first search over the integer CSR neighbour graph, returning the
+    path as kanji ids, or an empty array if the target can't be reached.
+    Paths are kept as parent pointers and only the successful one is rebuilt.
+    Every kanji is queued at most once, so the queue never outgrows the graph.
+    """
+    n_kanji = len(indptr) - 1
+    queue = np.empty(n_kanji, dtype=np.int32)
+    parent = np.full(n_kanji, -1, dtype=np.int32)
+    depth = np.zeros(n_kanji, dtype=np.int32)  # 0 means not yet queued
+
+    queue[0] = query
+    depth[query] = 1
+    head = 0
+    tail = 1
+    while head < tail:
+        current = queue[head]
+        head += 1
+        start = indptr[current]
+        stop = min(start + k, indptr[current + 1])
+
+        for e in range(start, stop):
+            if indices[e] == target:
+                length = depth[current]
+                path = np.empty(length + 1, dtype=np.int32)
+                path[length] = target
+                node = current
+                for i in range(length - 1, -1, -1):
+                    path[i] = node
+                    node = parent[node]
+                return path
+
+        if depth[current] < limit:
+            neighbours = indices[start:stop]
+            order = np.argsort(target_dists[neighbours], kind='mergesort')
+            for o in order:
+                neighbour = neighbours[o]
+                if depth[neighbour] == 0:
+                    parent[neighbour] = current
+                    depth[neighbour] = depth[current] + 1
+                    queue[tail] = neighbour
+                    tail += 1
 
-        if len(current) < limit:
-            # visit in similarity order if possible
-            try:
-                neighbours = sorted(neighbours, key=lambda n: sed(n, target))
-            except KeyError:
-                pass
-            neighbours = [n for n in neighbours if n not in shortest]
-            shortest.update(neighbours)
-            paths.extend((current + [n]) for n in neighbours)
+    return np.empty(0, dtype=np.int32)
 
 
 def _random_stumble(query, target, limit=5, k=settings.N_NEIGHBOURS_RECALLED, error_rate=0.0):
@@ -190,47 +287,127 @@ def _random_stumble(query, target, limit=5, k=settings.N_NEIGHBOURS_RECALLED, er
     """
     path = [query]
     while len(path) <= limit:
-        neighbours = _get_neighbours(path[-1], k=k)
+        neighbours = _get_neighbours(path[-1], k)
         if target in neighbours:
             if error_rate == 0.0 or random.random() < (1 - error_rate)**k:
                 return path + [target]
 
-            neighbours.remove(target)
+            neighbours = neighbours - {target}
 
         path.append(random.choice(list(neighbours)))
 
     return path
 
 
-class Cache(object):
-    """
-    A simple cache wrapper whose contents never expire. Useful for reducing
-    expensive calls on small datasets.
-    """
-    def __init__(self, f):
-        self.f = f
-        self._cached = {}
+# For every pivot, the frozenset of its stored neighbours (for membership
+# tests) and their ordered list (for top-k slicing), as filled in by
+# _preload_neighbours()
+FROZEN_NEIGHBOURS = {}
 
-    def __call__(self, *args, **kwargs):
-        key = args + tuple(kwargs.items())
-        if key not in self._cached:
-            self._cached[key] = self.f(*args, **kwargs)
 
-        return self._cached[key]
+def _preload_neighbours():
+    """Fetches the whole neighbour graph in a single sweep."""
+    if not FROZEN_NEIGHBOURS:
+        for node in models.Node.objects.only('pivot', 'neighbours'):
+            ordered = [n.kanji for n in node.neighbours]
+            FROZEN_NEIGHBOURS[node.pivot] = frozenset(ordered), ordered
 
-    def __contains__(self, key):
-        # workaround for StrokeEditDistance also acting like a container
-        return self.f.__contains__(key)
+
+def _get_neighbour_csr():
+    """
+    Fetches the neighbour graph in CSR form (indptr, indices) over the kanji
+    ids of the distance matrix, building it on first use.
+    """
+    if not hasattr(_get_neighbour_csr, '_cached'):
+        dist = _get_sed_matrix()
+        rows = [
+            [dist.index[n] for n in FROZEN_NEIGHBOURS[kanji][1]
+             if n in dist.index]
+            if kanji in FROZEN_NEIGHBOURS else []
+            for kanji in dist.kanji
+        ]
+        indptr = np.zeros(len(rows) + 1, dtype=np.int32)
+        indptr[1:] = np.cumsum([len(row) for row in rows])
+        indices = np.fromiter(itertools.chain.from_iterable(rows),
+                              dtype=np.int32, count=indptr[-1])
+        _get_neighbour_csr._cached = indptr, indices
+
+    return _get_neighbour_csr._cached
 
 
-@Cache
 def _get_neighbours(query, k=settings.N_NEIGHBOURS_RECALLED):
-    neighbours = set(n.kanji for n in models.Node.objects.get(
-            pivot=query).neighbours[:k])
+    neighbours, ordered = FROZEN_NEIGHBOURS[query]
+    if k < len(ordered):
+        # only a prefix of the stored neighbours is shown
+        neighbours = frozenset(ordered[:k])
+
     return neighbours
 
 
-sed = Cache(stroke.StrokeEditDistance())
+# all distance lookups go through SedMatrix, which is its own cache
+sed = stroke_numba.StrokeEditDistance()
+
+
+class SedMatrix(object):
+    """
+    Stroke edit distances between every pair of kanji, stored densely as raw
+    uint8 distances and normalised on lookup exactly as sed() is.
+    """
+    def __init__(self, metric):
+        self.kanji = sorted(models._get_kanji())
+        self.index = {kanji: i for i, kanji in enumerate(self.kanji)}
+        self.n_strokes = np.array(
+            [len(metric.signatures[kanji]) for kanji in self.kanji],
+            dtype=np.int32)
+        self.raw = self._load(metric)
+
+    def _load(self, metric):
+        # the matrix is expensive to build, so we keep a copy on disk keyed
+        # by the stroke data it was built from; the copy is only a speed-up,
+        # so we carry on without it if it can't be read or written
+        digest = hashlib.md5(
+            settings.mmap_data(settings.STROKE_SOURCE)).hexdigest()
+        matrix_file = os.path.join(settings.PARSED_CACHE_DIR,
+                                   f'sed_matrix_{digest}.npy')
+        n = len(self.kanji)
+        try:
+            raw = np.load(matrix_file)
+            if raw.shape == (n, n):
+                return raw
+        except (OSError, EOFError, ValueError):
+            pass
+
+        raw = metric.raw_distance_matrix(self.kanji)
+        settings.write_cache_file(matrix_file,
+                                  lambda ostream: np.save(ostream, raw))
+
+        return raw
+
+    def __call__(self, kanji_a, kanji_b):
+        i = self.index[kanji_a]
+        j = self.index[kanji_b]
+        return self.raw[i, j] / max(self.n_strokes[i], self.n_strokes[j])
+
+    def closest(self, options, target):
+        """
+        Returns the option nearest to the target. Ties go to the earliest
+        kanji in sorted order, as with min() over (distance, kanji) pairs.
+        """
+        idxs = np.fromiter((self.index[n] for n in options), dtype=np.int32,
+                           count=len(options))
+        idxs.sort()
+        j = self.index[target]
+        distances = self.raw[idxs, j] / np.maximum(self.n_strokes[idxs],
+                                                   self.n_strokes[j])
+        return self.kanji[idxs[distances.argmin()]]
+
+
+def _get_sed_matrix():
+    """Fetches the distance matrix, building it on first use."""
+    if not hasattr(_get_sed_matrix, '_cached'):
+        _get_sed_matrix._cached = SedMatrix(sed)
+
+    return _get_sed_matrix._cached
 
 # ---------------------------------------------------------------------------- #
 
@@ -261,6 +438,11 @@ def _create_option_parser():
         default=0.0, dest='error_rate',
         help='Factor in an estimated recognition error rate [0.0]')
 
+    parser.add_option(
+        '-j', action='store', type='int',
+        default=None, dest='processes',
+        help='The number of worker processes to use [all cores]')
+
     return parser
 
 
@@ -272,7 +454,8 @@ def main(argv):
         parser.print_help()
         sys.exit(1)
 
-    simulate_search(args[0], strategy=options.strategy, k=options.k, error_rate=options.error_rate)
+    simulate_search(args[0], strategy=options.strategy, k=options.k,
+                    error_rate=options.error_rate, processes=options.processes)
 
 # ---------------------------------------------------------------------------- #
 
@@ -12,14 +12,12 @@
 Database models for similarity search.
 """
 
-import os
-import codecs
-import gzip
+import time
 import itertools
+import threading
 
 import mongoengine
 from cjktools import scripts
-from cjktools.resources import kanjidic
 from nltk.probability import FreqDist, LaplaceProbDist
 
 from simsearch import stroke
@@ -27,7 +25,20 @@ from simsearch import heap_cache
 from simsearch import settings
 
 
-class Similarity(mongoengine.Document):
+class _Document(mongoengine.Document):
+    """
+    A document which connects to our database the first time it is used,
+    rather than when this module is imported.
+    """
+    meta = {'abstract': True}
+
+    @classmethod
+    def _get_db(cls):
+        settings.get_db_connection()
+        return super()._get_db()
+
+
+class Similarity(_Document):
     """Raw similarity scores for kanji pairs."""
     kanji_pair = mongoengine.StringField(max_length=2, primary_key=True)
     similarity = mongoengine.FloatField(min_value=0.0, max_value=1.0, required=True)
@@ -106,7 +117,7 @@ class Neighbour(mongoengine.EmbeddedDocument):
         return self.weight >= rhs.weight
 
 
-class Node(mongoengine.Document):
+class Node(_Document):
     """
     A single node in the state graph for Q-learning. The neighbours attribute
     stores Q(n, a) for all actions which can be taken from this node.
@@ -152,19 +163,7 @@ class Node(mongoengine.Document):
 
     @classmethod
     def _load_corpus_counts(cls):
-        input_file = os.path.join(settings.DATA_DIR, 'jp_char_corpus_counts.gz')
-        freq_dist = FreqDist()
-        with gzip.open(input_file, 'rb') as istream:
-
-            for line in istream:
-
-                kanji, count = line.split()
-
-                # Decode
-                kanji = kanji.decode()
-                count = count.decode()
-
-                freq_dist[kanji] += int(count)
+        freq_dist = FreqDist(settings.load_freq())
 
         return LaplaceProbDist(freq_dist)
 
@@ -205,7 +204,12 @@ class Node(mongoengine.Document):
                 a.weight = (1.0 - alpha) * q_old + alpha * q_opt
 
             q_s.n_updates += 1
-            q_s.save()
+            q_s.save(write_concern=settings.MONGODB_WRITE_CONCERN)
+
+        # neighbour order may have changed for these nodes
+        with _neighbour_cache_lock:
+            for pivot in path:
+                _neighbour_cache.pop(pivot, None)
 
     @classmethod
     def _cache_subgraph(cls, nodes):
@@ -244,7 +248,7 @@ class Node(mongoengine.Document):
         return self.pivot
 
 
-class Trace(mongoengine.Document):
+class Trace(_Document):
     """A search path through the graph, as taken by a user."""
     ip_address = mongoengine.StringField(max_length=15)
     path = mongoengine.ListField(mongoengine.StringField(max_length=1))
@@ -252,10 +256,11 @@ class Trace(mongoengine.Document):
     @classmethod
     def log(cls, request, path):
         ip = request.remote_addr
-        cls(ip_address=ip, path=list(path)).save()
+        cls(ip_address=ip, path=list(path)).save(
+                write_concern=settings.MONGODB_WRITE_CONCERN)
 
 
-class Translation(mongoengine.Document):
+class Translation(_Document):
     """A per-kanji dictionary entry of readings and translations."""
     kanji = mongoengine.StringField(max_length=1, primary_key=True)
     on_readings = mongoengine.ListField(mongoengine.StringField())
@@ -265,12 +270,9 @@ class Translation(mongoengine.Document):
     @classmethod
     def build(cls):
         cls.drop_collection()
-        kjd = kanjidic.Kanjidic(
-            kanjidic_files=[
-                settings.KANJI_DIC,
-                settings.KANJI_D212
-            ])
-        for entry in kjd.values():
+        entries = itertools.chain(settings.load_kanjidic().values(),
+                                  settings.load_kanjd212().values())
+        for entry in entries:
             translation = cls(
                     kanji=entry.kanji,
                     on_readings=entry.on_readings,
@@ -280,6 +282,36 @@ class Translation(mongoengine.Document):
             translation.save()
 
 
+# pivot -> (expiry time, neighbours), oldest first
+_neighbour_cache = {}
+_neighbour_cache_lock = threading.Lock()
+
+
+def cached_neighbours(pivot):
+    """
+    The neighbours of the given kanji, best first, as stored in the graph.
+    Raises DoesNotExist if the kanji has no node. Results are kept for up to
+    NEIGHBOUR_CACHE_SECONDS, or until this process updates the node.
+    """
+    now = time.monotonic()
+    entry = _neighbour_cache.get(pivot)
+    if entry is not None and entry[0] > now:
+        return entry[1]
+
+    node = Node.objects.get(pivot=pivot)
+    neighbours = tuple(n.kanji for n in sorted(node.neighbours, reverse=True))
+
+    with _neighbour_cache_lock:
+        _neighbour_cache.pop(pivot, None)
+        while len(_neighbour_cache) >= settings.NEIGHBOUR_CACHE_SIZE:
+            # evict the oldest entry
+            del _neighbour_cache[next(iter(_neighbour_cache))]
+        _neighbour_cache[pivot] = (now + settings.NEIGHBOUR_CACHE_SECONDS,
+                                   neighbours)
+
+    return neighbours
+
+
 def build():
     """Builds the database."""
     cache = Similarity.build()
@@ -293,17 +325,14 @@ def _get_kanji():
     """Fetches our canonical list of kanji to work with."""
     if not hasattr(_get_kanji, '_cached'):
         kanji_set = set()
-        with codecs.open(settings.STROKE_SOURCE, 'r', 'utf8') as istream:
-            for line in istream:
-                kanji, rest = line.split()
-                
-                # check for a kanji or hanzi; our Chinese data extends into
-                # the E000-F8FF private use block, so an "Unknown" script is
-                # ok too
-                assert len(kanji) == 1 and scripts.script_type(kanji) in \
-                        (scripts.Script.Kanji, scripts.Script.Unknown)
-
-                kanji_set.add(kanji)
+        for kanji in settings.load_stroke():
+            # check for a kanji or hanzi; our Chinese data extends into
+            # the E000-F8FF private use block, so an "Unknown" script is
+            # ok too
+            assert len(kanji) == 1 and scripts.script_type(kanji) in \
+                    (scripts.Script.Kanji, scripts.Script.Unknown)
+
+            kanji_set.add(kanji)
 
         _get_kanji._cached = kanji_set
 
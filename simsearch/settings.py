@@ -13,8 +13,22 @@ Settings for the simsearch project.
 """
 
 import os
+import gzip
+import mmap
+import pickle
+import hashlib
+import functools
+import importlib.util
+from pathlib import Path
 
-import mongoengine
+import numpy as np
+
+# Importing this file under a second name (e.g. plain "settings", with the
+# package directory on sys.path) would give a second copy of every setting,
+# and a second database connection pool.
+if __name__ != 'simsearch.settings':
+    raise ImportError(f'settings imported as {__name__!r}; use '
+                      f'"from simsearch import settings" instead')
 
 # custom MongoDB connection settings
 MONGODB_NAME = 'simsearch'
@@ -23,43 +37,437 @@ MONGODB_PASSWORD = None
 MONGODB_HOST = 'localhost'
 MONGODB_PORT = 27017
 
+# connection pool sizing, passed through to pymongo's MongoClient
+MONGODB_MAX_POOL_SIZE = 200
+MONGODB_MIN_POOL_SIZE = 10
+MONGODB_MAX_IDLE_TIME_MS = 300000
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = 2500
+
+# fail fast rather than wait on pymongo's 30s default when the server is down
+MONGODB_SERVER_SELECTION_TIMEOUT_MS = 3000
+MONGODB_CONNECT_TIMEOUT_MS = 2000
+MONGODB_SOCKET_TIMEOUT_MS = 5000
+
+# reported to the server, to tell our connections apart when profiling
+MONGODB_APPNAME = 'simsearch'
+
+# wire compression, in order of preference; those whose libraries aren't
+# installed (see the wire-compression extra) are skipped. zlib needs no extra
+# library, but costs CPU for little gain on a local server, so sites opt in
+# by adding it here.
+MONGODB_COMPRESSORS = ('zstd', 'snappy')
+MONGODB_ZLIB_COMPRESSION_LEVEL = 6
+
+# A full connection string, taken from the environment if given, overrides
+# all the settings above. This is where to ask for wire compression, retried
+# reads or replica set options, e.g.
+# mongodb://host:27017/simsearch?compressors=zstd,snappy&retryReads=true
+MONGODB_URI = os.environ.get('MONGODB_URI')
+
+# Whether an asyncio (motor) client may be opened too, see get_async_db()
+ASYNC_DB = os.environ.get('SIMSEARCH_ASYNC', '0') == '1'
+
 UTF8_BYTES_PER_CHAR = 3  # for CJK chars
 
 N_NEIGHBOURS_STORED = 100
 
 N_NEIGHBOURS_RECALLED = 15
 
+# How many kanji's neighbour lists each server process keeps in memory, and
+# for how long; graph updates made by other processes show up once an entry
+# expires
+NEIGHBOUR_CACHE_SIZE = 1024
+NEIGHBOUR_CACHE_SECONDS = 60
+
 # GOOGLE_ANALYTICS_CODE = None
 
+# Compress HTML and JSON responses larger than this many bytes
+ENABLE_HTTP_GZIP = True
+GZIP_MIN_LENGTH = 200
+
 # Tradeoff in Pr(a|s) and likelihood of reaching a further target from s'
 UPDATE_GAMMA = 0.7
 
-PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
-
-
-# Absolute path to the directory that holds media.
-# Example: "/home/media/media.lawrence.com/"
-MEDIA_ROOT = os.path.join(PROJECT_ROOT, 'media')
+# Write concern for the frequent small writes made while serving searches,
+# i.e. graph updates and search traces. These can be rebuilt or lost without
+# harm, so we don't wait on the journal.
+MONGODB_WRITE_CONCERN = {'w': 1, 'j': False}
 
 # URL that handles the media served from MEDIA_ROOT. Make sure to use a
 # trailing slash if there is a path component (optional in other cases).
 # Examples: "http://media.lawrence.com", "http://example.com/media/"
 MEDIA_URL = '/static/'
 
-# static data files needed for building
-DATA_DIR = os.path.join(PROJECT_ROOT, 'data')
 
-# The source of stroke data for each character
-STROKE_SOURCE = os.path.join(DATA_DIR, 'stroke_ulrich')
+class _Settings(object):
+    """
+    Settings which are paths, each resolved on first access rather than at
+    import. They are read as module attributes, e.g. settings.DATA_DIR, and
+    each is derived from those before it, so that overriding PROJECT_ROOT or
+    DATA_DIR in local_settings moves everything below it too.
+    """
+    @functools.cached_property
+    def PROJECT_ROOT(self):
+        return str(Path(__file__).resolve().parent)
+
+    @functools.cached_property
+    def MEDIA_ROOT(self):
+        """
+        Absolute path to the directory that holds media. Code which writes
+        media should create it with ensure_dir().
+        """
+        return os.path.join(self.PROJECT_ROOT, 'media')
+
+    @functools.cached_property
+    def DATA_DIR(self):
+        """Static data files needed for building."""
+        return os.path.join(self.PROJECT_ROOT, 'data')
+
+    @functools.cached_property
+    def STROKE_SOURCE(self):
+        """The source of stroke data for each character."""
+        return data_path('stroke_ulrich')
+
+    @functools.cached_property
+    def FREQ_SOURCE(self):
+        """The source of frequency counts for each character."""
+        return data_path('jp_char_corpus_counts.gz')
+
+    @functools.cached_property
+    def FREQ_SOURCE_INDEX(self):
+        """
+        A seek-point index for FREQ_SOURCE, written after the first full read
+        when rapidgzip is available.
+        """
+        return self.FREQ_SOURCE + '.gzi'
+
+    @functools.cached_property
+    def FREQ_SOURCE_NPY(self):
+        """
+        FREQ_SOURCE decompressed ahead of time into a numpy array of
+        (codepoint, count) records, by simsearch.build_freq_index.
+        """
+        return os.path.join(self.DATA_DIR, 'jp_char_corpus_counts.npy')
+
+    @functools.cached_property
+    def KANJI_DIC(self):
+        return data_path('kanjidic')
+
+    @functools.cached_property
+    def KANJI_D212(self):
+        return data_path('kanjd212')
+
+    @functools.cached_property
+    def PARSED_CACHE_DIR(self):
+        """
+        Parsed copies of the data files above, and other derived data, are
+        kept here so that they can be reloaded quickly.
+        """
+        return os.path.join(self.DATA_DIR, '.cache')
+
+
+_settings = _Settings()
+
+_SETTINGS_NAMES = frozenset(
+    k for (k, v) in vars(_Settings).items()
+    if isinstance(v, functools.cached_property) and not k.startswith('_')
+)
+
+# site-specific overrides; errors raised from within local_settings itself
+# are not swallowed
+if importlib.util.find_spec('local_settings') is not None:
+    _local_settings = importlib.import_module('local_settings')
+    for _k in getattr(_local_settings, '__all__', vars(_local_settings)):
+        if _k.startswith('_'):
+            continue
+        if _k in _SETTINGS_NAMES:
+            setattr(_settings, _k, getattr(_local_settings, _k))
+        else:
+            globals()[_k] = getattr(_local_settings, _k)
+
+
+@functools.lru_cache(maxsize=None)
+def data_path(name):
+    """The path to a static data file, checked to exist on first lookup."""
+    path = os.path.join(_settings.DATA_DIR, name)
+    assert os.path.exists(path), path
+    return path
+
+
+@functools.lru_cache(maxsize=None)
+def mmap_data(path):
+    """
+    Maps a file read-only into memory, once per process, and returns a
+    memoryview of it. Pages are served from the OS page cache, and so are
+    shared between worker processes. Unlike the map itself, the view has no
+    file position, so every caller can share it safely.
+    """
+    with open(path, 'rb') as istream:
+        return memoryview(
+            mmap.mmap(istream.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+def read_data_file(name):
+    """The raw contents of a static data file, as a read-only buffer."""
+    return mmap_data(data_path(name))
+
+
+def read_freq_source():
+    """
+    Returns the decompressed text of FREQ_SOURCE. If rapidgzip is installed,
+    decompression runs in parallel and reuses the index saved alongside the
+    source; otherwise we fall back to serial gzip.
+    """
+    try:
+        import rapidgzip
+    except ImportError:
+        with gzip.open(_settings.FREQ_SOURCE, 'rt',
+                       encoding='utf8') as istream:
+            return istream.read()
+
+    index_file = _settings.FREQ_SOURCE_INDEX
+    if os.path.exists(index_file):
+        try:
+            with rapidgzip.open(_settings.FREQ_SOURCE,
+                                parallelization=os.cpu_count()) as istream:
+                with open(index_file, 'rb') as index_stream:
+                    istream.import_index(index_stream)
+                return istream.read().decode('utf8')
+        except (OSError, RuntimeError):
+            # an unreadable or damaged index; read without it and rewrite it
+            pass
+
+    with rapidgzip.open(_settings.FREQ_SOURCE,
+                        parallelization=os.cpu_count()) as istream:
+        data = istream.read()
+
+        # the index is only a speed-up, so failing to save it (e.g. in a
+        # read-only install) is fine; write then rename, so that concurrent
+        # readers never see a partial file
+        tmp_file = f'{index_file}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_file, 'wb') as index_stream:
+                istream.export_index(index_stream)
+            os.replace(tmp_file, index_file)
+        except (OSError, RuntimeError):
+            _remove_quietly(tmp_file)
+
+    return data.decode('utf8')
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_dir(path):
+    """Creates the directory if need be, checking only once per process."""
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+# Bump this whenever a _parse_*() function changes what it returns, so that
+# pickles written by the old code are no longer used
+_PARSED_CACHE_VERSION = 2
+
+
+def cached_parse(src_path, parser):
+    """
+    Returns parser(src_path), reusing a pickled copy from PARSED_CACHE_DIR
+    unless src_path has been modified since it was written. The pickle is
+    only a speed-up: if it can't be read or written, we just parse.
+    """
+    key = hashlib.md5(
+        f'{_PARSED_CACHE_VERSION}:{src_path}:{parser.__name__}'.encode()
+    ).hexdigest()
+    cache_file = os.path.join(_settings.PARSED_CACHE_DIR, key + '.pkl')
+    try:
+        if os.path.getmtime(cache_file) >= os.path.getmtime(src_path):
+            with open(cache_file, 'rb') as istream:
+                return pickle.load(istream)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+
+    value = parser(src_path)
+    write_cache_file(cache_file,
+                     lambda ostream: pickle.dump(value, ostream, protocol=5))
+
+    return value
+
+
+def write_cache_file(cache_file, write):
+    """
+    Calls write() on a binary stream to save a cache file. The file is only a
+    speed-up, so failing to write it (e.g. in a read-only install) is fine; we
+    write then rename, so that concurrent readers never see a partial file.
+    """
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    try:
+        ensure_dir(os.path.dirname(cache_file))
+        with open(tmp_file, 'wb') as ostream:
+            write(ostream)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        _remove_quietly(tmp_file)
+
+
+def __getattr__(name):
+    if name in _SETTINGS_NAMES:
+        return getattr(_settings, name)
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+# ---------------------------------------------------------------------------- #
+# Parsed data files. Each is parsed on first use and then shared by every
+# caller in the process, so treat the results as read-only.
+
+
+@functools.lru_cache(maxsize=1)
+def load_stroke():
+    """Maps each kanji in STROKE_SOURCE to its tuple of stroke types."""
+    return cached_parse(_settings.STROKE_SOURCE, _parse_stroke)
+
+
+@functools.lru_cache(maxsize=1)
+def load_freq():
+    """Maps each kanji in FREQ_SOURCE to its corpus count."""
+    freq_array = _load_freq_array()
+    if freq_array is not None:
+        return dict(zip(map(chr, freq_array['cp'].tolist()),
+                        freq_array['count'].tolist()))
+
+    return cached_parse(_settings.FREQ_SOURCE, _parse_freq)
+
+
+def _load_freq_array():
+    # only trust the array if it was built from the current FREQ_SOURCE
+    npy_file = _settings.FREQ_SOURCE_NPY
+    src_file = _settings.FREQ_SOURCE
+    if os.path.exists(npy_file) and \
+            os.path.getmtime(npy_file) >= os.path.getmtime(src_file):
+        return np.load(npy_file, mmap_mode='r')
+
+
+@functools.lru_cache(maxsize=1)
+def load_kanjidic():
+    """The kanjidic entries from KANJI_DIC, keyed by kanji."""
+    return cached_parse(_settings.KANJI_DIC, _parse_kanjidic)
+
+
+@functools.lru_cache(maxsize=1)
+def load_kanjd212():
+    """The kanjidic entries from KANJI_D212, keyed by kanji."""
+    return cached_parse(_settings.KANJI_D212, _parse_kanjidic)
+
+
+def _parse_stroke(path):
+    signatures = {}
+    for line in mmap_data(path).tobytes().splitlines():
+        kanji, raw_strokes = line.decode('utf8').split()
+        signatures[kanji] = tuple(raw_strokes.split(','))
+
+    return signatures
+
+
+def _parse_freq(path):
+    # read_freq_source() knows how to decompress FREQ_SOURCE quickly
+    assert path == _settings.FREQ_SOURCE
+    counts = {}
+    for line in read_freq_source().splitlines():
+        kanji, count = line.split()
+        counts[kanji] = counts.get(kanji, 0) + int(count)
+
+    return counts
+
+
+def _parse_kanjidic(path):
+    from cjktools.resources import kanjidic
+    return kanjidic.Kanjidic(kanjidic_files=[path])
+
+# ---------------------------------------------------------------------------- #
+
+
+@functools.lru_cache(maxsize=1)
+def get_db_connection():
+    """
+    Connects to our database on first use, so that importing settings alone
+    never touches MongoDB. If another copy of this module already registered
+    a connection (and with it a pool) for this process, that one is reused.
+    """
+    import mongoengine
+    from mongoengine.connection import get_connection, ConnectionFailure
+
+    try:
+        return get_connection()
+    except ConnectionFailure:
+        pass
+
+    if MONGODB_URI:
+        return mongoengine.connect(MONGODB_NAME, host=MONGODB_URI)
+
+    return mongoengine.connect(MONGODB_NAME, **_client_options())
+
+
+@functools.lru_cache(maxsize=1)
+def get_async_db():
+    """
+    The database through an asyncio client (motor), for code which runs on
+    an event loop. It keeps its own pool, separate from get_db_connection(),
+    and must be used from a single event loop. Only available when ASYNC_DB
+    is set, so that no second pool is opened by accident.
+    """
+    if not ASYNC_DB:
+        raise RuntimeError('the async client is disabled; set '
+                           'SIMSEARCH_ASYNC=1 to enable it')
+
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    if MONGODB_URI:
+        client = AsyncIOMotorClient(MONGODB_URI)
+    else:
+        client = AsyncIOMotorClient(**_client_options())
+
+    return client.get_default_database(MONGODB_NAME)
+
+
+def _client_options():
+    options = dict(
+        username=MONGODB_USERNAME,
+        password=MONGODB_PASSWORD, host=MONGODB_HOST, port=MONGODB_PORT,
+        maxPoolSize=MONGODB_MAX_POOL_SIZE,
+        minPoolSize=MONGODB_MIN_POOL_SIZE,
+        maxIdleTimeMS=MONGODB_MAX_IDLE_TIME_MS,
+        waitQueueTimeoutMS=MONGODB_WAIT_QUEUE_TIMEOUT_MS,
+        serverSelectionTimeoutMS=MONGODB_SERVER_SELECTION_TIMEOUT_MS,
+        connectTimeoutMS=MONGODB_CONNECT_TIMEOUT_MS,
+        socketTimeoutMS=MONGODB_SOCKET_TIMEOUT_MS,
+        appname=MONGODB_APPNAME,
+        retryWrites=True)
+
+    # pymongo warns about an empty compressors list, so leave it unset
+    compressors = _available_compressors()
+    if compressors:
+        options['compressors'] = ','.join(compressors)
+    if 'zlib' in compressors:
+        options['zlibCompressionLevel'] = MONGODB_ZLIB_COMPRESSION_LEVEL
+
+    return options
 
-# The source of frequency counts for each character
-FREQ_SOURCE = os.path.join(DATA_DIR, 'jp_char_corpus_counts.gz')
 
-KANJI_DIC = os.path.join(DATA_DIR, 'kanjidic')
+def _available_compressors():
+    import pymongo
 
-KANJI_D212 = os.path.join(DATA_DIR, 'kanjd212')
+    # the third-party module each compressor needs, if any
+    modules = {'zstd': 'zstandard', 'snappy': 'snappy', 'zlib': None}
+    if pymongo.version_tuple < (3, 11):
+        # zstd support arrived in pymongo 3.11
+        del modules['zstd']
 
-# connect to our database
-mongoengine.connect(
-    MONGODB_NAME, username=MONGODB_USERNAME,
-    password=MONGODB_PASSWORD, host=MONGODB_HOST, port=MONGODB_PORT)
+    return [
+        c for c in MONGODB_COMPRESSORS
+        if c in modules and (modules[c] is None
+                             or importlib.util.find_spec(modules[c]))
+    ]
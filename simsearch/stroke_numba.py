@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+#
+#  stroke_numba.py
+#  simsearch
+#
+#  Port of stroke.pyx by Lars Yencken.
+
+"""
+Numba-compiled Levenstein distance calculation between stroke signatures for
+two kanji. A drop-in alternative to the Cython stroke module which needs no
+extension build step.
+"""
+
+import numpy as np
+from numba import njit
+
+from simsearch import settings
+
+
+class StrokeEditDistance(object):
+    """The edit distance between stroke sequences for both kanji."""
+
+    def __init__(self, input_file=None):
+        self.stroke_types = {}
+        self.n_stroke_types = 0
+
+        if input_file is None:
+            raw_signatures = settings.load_stroke().items()
+        else:
+            with open(input_file, encoding='utf8') as istream:
+                raw_signatures = [
+                    (kanji, raw_strokes.split(','))
+                    for kanji, raw_strokes in map(str.split, istream)
+                ]
+
+        self.signatures = {}
+        for kanji, raw_strokes in raw_signatures:
+            strokes = list(map(self.get_stroke_type, raw_strokes))
+            self.signatures[kanji] = np.array(strokes, dtype=np.int8)
+
+    def get_stroke_type(self, stroke):
+        try:
+            return self.stroke_types[stroke]
+        except KeyError:
+            pass
+
+        self.stroke_types[stroke] = self.n_stroke_types
+        self.n_stroke_types += 1
+
+        return self.n_stroke_types - 1
+
+    def raw_distance(self, kanji_a, kanji_b):
+        return int(_sed(self.signatures[kanji_a], self.signatures[kanji_b]))
+
+    def __call__(self, kanji_a, kanji_b):
+        s = self.signatures[kanji_a]
+        t = self.signatures[kanji_b]
+        return float(_sed(s, t)) / max(len(s), len(t))
+
+    def raw_distance_matrix(self, kanji_list):
+        """
+        Computes the raw distance between every pair of the given kanji,
+        returning a dense uint8 matrix indexed by position in kanji_list.
+        """
+        signatures = [self.signatures[kanji] for kanji in kanji_list]
+        offsets = np.zeros(len(signatures) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in signatures])
+        return _sed_matrix(np.concatenate(signatures), offsets)
+
+    def __contains__(self, kanji):
+        return kanji in self.signatures
+
+# ---------------------------------------------------------------------------- #
+
+
+@njit(cache=True)
+def _sed(s, t):
+    """
+    The edit distance between two int8 stroke sequences, keeping only a
+    single rolling row of the dynamic programming table.
+    """
+    t_len = len(t)
+    row = np.empty(t_len + 1, dtype=np.int32)
+    for j in range(t_len + 1):
+        row[j] = j
+
+    for i in range(1, len(s) + 1):
+        diag = row[0]
+        row[0] = i
+        for j in range(1, t_len + 1):
+            if s[i - 1] == t[j - 1]:
+                cost = 0
+            else:
+                cost = 1
+
+            up = row[j] + 1
+            left = row[j - 1] + 1
+            diag, row[j] = row[j], min(up, left, diag + cost)
+
+    return row[t_len]
+
+
+@njit(cache=True)
+def _sed_matrix(strokes, offsets):
+    """
+    All-pairs edit distances between the stroke sequences packed end to end in
+    strokes, where sequence i spans offsets[i]:offsets[i + 1]. Only the upper
+    triangle is computed and mirrored, since the distance is symmetric. Kept
+    serial: a threaded kernel run before the simulation forks its worker pool
+    leaves the workers unable to exit.
+    """
+    n = len(offsets) - 1
+    dist = np.zeros((n, n), dtype=np.uint8)
+    for i in range(n):
+        s = strokes[offsets[i]:offsets[i + 1]]
+        for j in range(i + 1, n):
+            d = _sed(s, strokes[offsets[j]:offsets[j + 1]])
+            dist[i, j] = d
+            dist[j, i] = d
+
+    return dist